@@ -14,10 +14,14 @@
 ###########################################
 ###########################################
 
+import functools
 import serial
 import re
+import struct
 import sys
+import threading
 import time
+import Queue
 import tellie_exception
 import tellie_logger
 import parameters
@@ -26,7 +30,7 @@ import parameters
 _max_pulse_height = 16383
 _max_pulse_width = 16383
 _max_lo = 255.
-_max_pulse_delay = 256.020
+_max_pulse_delay = 255.996  # 255 ms plus 249 4us steps
 _min_pulse_delay = 0.1
 _max_trigger_delay = 1275
 _max_fibre_delay = 127.5
@@ -35,39 +39,74 @@ _max_pulse_number_upper = 255
 _max_pulse_number_lower = 255
 _max_temp_probe = 64
 
-_cmd_fire_continuous = "a"
-_cmd_read_single_lower = "r"
-_cmd_read_single_upper = "m"
-_cmd_fire_average_lower = "s"
-_cmd_fire_average_upper = "U"
-_cmd_fire_series = "g"
-_buffer_end_sequence = "K"
-_cmd_stop = "X"
-_cmd_channel_clear = "C"
-_cmd_channel_select_single_start = "I"
-_cmd_channel_select_single_end = "N"
-_cmd_channel_select_many_start = "J"
-_cmd_channel_select_many_end = "E"
-_cmd_ph_hi = "L"
-_cmd_ph_lo = "M"
-_cmd_ph_end = "P"
-_cmd_pw_hi = "Q"
-_cmd_pw_lo = "R"
-_cmd_pw_end = "S"
-_cmd_pn_hi = "H"
-_cmd_pn_lo = "G"
-_cmd_pd = "u"
-_cmd_td = "d"
-_cmd_fd = "e"
-_cmd_temp_select_lower = "n"
-_cmd_temp_read_lower = "T"
-_cmd_temp_select_upper = "f"
-_cmd_temp_read_upper = "k"
-_cmd_disable_ext_trig = "B"
-_cmd_enable_ext_trig = "A"
-_cmd_fire_average_ext_trig_lower = "p"
-_cmd_fire_average_ext_trig_upper = "b"
-_cmd_fire_ext_trig = "F"
+# Reset timing (s): RTS hold, boot time, and limit on waiting for the boot
+# output to go quiet
+_rts_hold = 0.05
+_boot_wait = 0.2
+_boot_timeout = 0.5
+# Draining the port (s): stop once quiet for _idle_gap, which must exceed
+# the FTDI default 16ms latency timer in case low latency mode could not be
+# set, and give up after _idle_timeout
+_idle_timeout = 0.3
+_idle_gap = 0.02
+# Wait (s) between PIN readout attempts after a single fire
+_pin_poll_interval = 0.001
+# Wait (s) between end of fire checks in check_firing
+_firing_poll_interval = 0.005
+
+_cmd_fire_continuous = b"a"
+_cmd_read_single_lower = b"r"
+_cmd_read_single_upper = b"m"
+_cmd_fire_average_lower = b"s"
+_cmd_fire_average_upper = b"U"
+_cmd_fire_series = b"g"
+_buffer_end_sequence = b"K"
+_cmd_stop = b"X"
+_cmd_channel_clear = b"C"
+_cmd_channel_select_single_start = b"I"
+_cmd_channel_select_single_end = b"N"
+_cmd_channel_select_many_start = b"J"
+_cmd_channel_select_many_end = b"E"
+_cmd_ph_hi = b"L"
+_cmd_ph_lo = b"M"
+_cmd_ph_end = b"P"
+_cmd_pw_hi = b"Q"
+_cmd_pw_lo = b"R"
+_cmd_pw_end = b"S"
+_cmd_pn_hi = b"H"
+_cmd_pn_lo = b"G"
+_cmd_pd = b"u"
+_cmd_td = b"d"
+_cmd_fd = b"e"
+_cmd_temp_select_lower = b"n"
+_cmd_temp_read_lower = b"T"
+_cmd_temp_select_upper = b"f"
+_cmd_temp_read_upper = b"k"
+_cmd_disable_ext_trig = b"B"
+_cmd_enable_ext_trig = b"A"
+_cmd_fire_average_ext_trig_lower = b"p"
+_cmd_fire_average_ext_trig_upper = b"b"
+_cmd_fire_ext_trig = b"F"
+
+# Linux serial ioctls, used to put the FTDI chip into low latency mode
+_TIOCGSERIAL = 0x541E
+_TIOCSSERIAL = 0x541F
+_ASYNC_LOW_LATENCY = 0x2000
+_serial_struct_size = 0x48
+_serial_struct_flags_offset = 16
+
+# Pre-built packers for the setting commands, and echo strings for hi/lo ones
+_ph_pack = struct.Struct(">cBcBc").pack
+_pw_pack = struct.Struct(">cBcBc").pack
+_pn_pack = struct.Struct(">cBcB").pack
+_pd_pack = struct.Struct(">cBB").pack
+_td_pack = struct.Struct(">cB").pack
+_fd_pack = struct.Struct(">cB").pack
+_ph_buffer_check = _cmd_ph_hi + _cmd_ph_lo + _cmd_ph_end
+_pw_buffer_check = _cmd_pw_hi + _cmd_pw_lo + _cmd_pw_end
+_pn_buffer_check = _cmd_pn_hi + _cmd_pn_lo
+# echo from a short fire that completes within the read timeout
+_fire_complete_buffer_check = _cmd_fire_series + _buffer_end_sequence
 
 
 class SerialCommand(object):
@@ -75,8 +114,13 @@ class SerialCommand(object):
     Base class, different chips then inheret from this.
     """
 
-    def __init__(self, port_name=None):
-        """Initialise the serial command"""
+    def __init__(self, port_name=None, pipelined=False):
+        """Initialise the serial command.
+        If pipelined, setting commands are queued and sent by a background
+        thread; any error is raised by the next command that needs the port.
+        The thread holds a reference to this object, so a pipelined
+        instance must be close()d to stop it and release the port.
+        """
         if not port_name:
             self._port_name = "/dev/ttyUSB0"
         else:
@@ -84,110 +128,235 @@ class SerialCommand(object):
         # This is the same as a sleep, but with the advantage of breaking
         # if enough characters are seen in the buffer.
         self._port_timeout = 0.3
+        # commands are a few bytes, so a stalled write means a lost device
+        self._write_timeout = 0.1
         self._serial = None
+        # background sender for setting commands (pipelined mode only)
+        self._io_thread = None
+        self._io_queue = None
+        self._io_error = None
         self.logger = tellie_logger.TellieLogger.get_instance()
         try:
+            # 8N1, no flow control; pyserial also sets raw mode on POSIX
             self._serial = serial.Serial(port=self._port_name,
-                                         timeout=self._port_timeout)
-            self.logger.debug("Serial connection open: %s" % self._serial)
+                                         bytesize=serial.EIGHTBITS,
+                                         parity=serial.PARITY_NONE,
+                                         stopbits=serial.STOPBITS_ONE,
+                                         xonxoff=False,
+                                         rtscts=False,
+                                         dsrdtr=False,
+                                         timeout=self._port_timeout,
+                                         write_timeout=self._write_timeout,
+                                         inter_byte_timeout=None)
+            self.logger.debug("Serial connection open: %s", self._serial)
         except serial.SerialException, e:
             raise tellie_exception.TellieSerialException(e)
+        # bound methods, saves the attribute lookups on every command
+        self._write = self._serial.write
+        self._read = self._serial.read
+        self._set_low_latency()
         # cache current settings - remove need to re-command where possible
-        self._current_ph = None
+        self._current = dict.fromkeys(_setting_encoders)
         self._current_fd = None
-        self._current_pn = None
-        self._current_pd = None
-        self._current_td = None
+        # pulse number * pulse delay, refreshed whenever either is set
+        self._expected_duration = 0
         # information on whether the channel is being fired
         self._firing = False  # must wait for firing to complete
+        # bytes read while waiting for the end of a fire
+        self._rx_buf = bytearray()
         # if a new channel is selected should force setting all new parameters
         # restriction only lifted once a fire command has been called
         self._force_setting = False
         # send a reset, to ensure the RTS is set to false
         self.reset()
+        if pipelined:
+            self._start_io_worker()
         # Slave mode can be re-instated later if required.
         #self._send_command(_cmd_disable_ext_trig)
 
     def __del__(self):
         """Deletion function"""
-        if self._serial:
-            # Stop accecpting external trigs
-            #self._send_command(_cmd_disable_ext_trig)
-            self._serial.close()
+        try:
+            self.close()
+        except Exception, e:
+            self.logger.warn("Error from queued setting on close: %s" % e)
+
+    def close(self):
+        """Send any queued settings, stop the IO thread and close the port.
+        Errors from the queued settings are still raised."""
+        try:
+            self._wait_pending()
+        finally:
+            if self._io_thread is not None:
+                self._io_queue.put(None)
+                self._io_thread.join()
+                self._io_thread = None
+                self._io_queue = None
+            if self._serial:
+                # Stop accecpting external trigs
+                #self._send_command(_cmd_disable_ext_trig)
+                self._serial.close()
+                self._serial = None
+
+    def _set_low_latency(self):
+        """Set ASYNC_LOW_LATENCY on the port (Linux only).
+        The FTDI driver otherwise holds short replies for up to 16ms
+        before flushing them over USB."""
+        if not sys.platform.startswith("linux"):
+            return
+        import fcntl
+        try:
+            fd = self._serial.fileno()
+            buf = bytearray(fcntl.ioctl(fd, _TIOCGSERIAL,
+                                        b"\0" * _serial_struct_size))
+            flags, = struct.unpack_from("i", buf, _serial_struct_flags_offset)
+            struct.pack_into("i", buf, _serial_struct_flags_offset,
+                             flags | _ASYNC_LOW_LATENCY)
+            fcntl.ioctl(fd, _TIOCSSERIAL, bytes(buf))
+        except (IOError, OSError, AttributeError, ValueError), e:
+            self.logger.debug("Could not set low latency mode: %s", e)
+
+    def _start_io_worker(self):
+        """Start the daemon thread that sends queued setting commands"""
+        self._io_queue = Queue.Queue()
+        self._io_thread = threading.Thread(target=self._io_loop,
+                                           name="tellie-serial-io")
+        self._io_thread.daemon = True
+        self._io_thread.start()
+
+    def _io_loop(self):
+        """Send queued setting commands in order, until a None is queued.
+        After an error the rest of the queue is dropped until the error has
+        been raised in the caller's thread."""
+        while True:
+            item = self._io_queue.get()
+            if item is None:
+                self._io_queue.task_done()
+                return
+            command, buffer_check = item
+            try:
+                if self._io_error is None:
+                    self._check_clear_buffer()
+                    self._send_command_bytes(command=command,
+                                             buffer_check=buffer_check)
+            except Exception, e:
+                self._io_error = e
+            finally:
+                self._io_queue.task_done()
+
+    def _wait_pending(self):
+        """Block until all queued setting commands have been sent.
+        Re-raises any error from the IO thread; cached settings are cleared
+        in that case as the device state is unknown."""
+        if self._io_thread is None or \
+           threading.current_thread() is self._io_thread:
+            return
+        self._io_queue.join()
+        if self._io_error is not None:
+            error = self._io_error
+            self._io_error = None
+            self.clear_settings()
+            raise error
 
     def _check_clear_buffer(self):
         """Many commands expect an empty buffer, fail if they are not!
+        Only reads if bytes are waiting, so an empty buffer costs no timeout.
         """
-        buffer_read = self._serial.read(100)
-        if buffer_read != "":
-            raise tellie_exception.TellieException(
-                "Buffer not clear: %s" % (buffer_read))
+        n = self._serial.in_waiting
+        if n == 0:
+            return
+        buffer_read = self._read(n)
+        raise tellie_exception.TellieException(
+            "Buffer not clear: %s" % (buffer_read))
 
     def _send_command(self, command, readout=True, buffer_check=None):
         """Send a command to the serial port.
-        Command can be a chr/str (single write) or a list.
-        Lists are used for e.g. a high/low bit command where
-        the high bit could finish with an endline (i.e. endstream)"""
-        self.logger.debug("_send_command:%s" % command)
-        if type(command) is str:
-            command = [command]
-        if type(command) is not list:
+        Command can be a bytes string or a list of fragments; lists are
+        joined so that the whole command goes out in a single write."""
+        if type(command) is list:
+            command = b"".join(command)
+        if type(command) is not bytes:
             raise tellie_exception.TellieException(
-                "Command is not a list: %s %s" % (command, type(command)))
+                "Command is not bytes: %s %s" % (command, type(command)))
+        self._send_command_bytes(command, readout, buffer_check)
+
+    def _send_command_bytes(self, command, readout=True, buffer_check=None):
+        """Send a bytes command to the serial port, as a single write.
+        Callers that already hold bytes use this to skip the type dispatch
+        in _send_command."""
+        self._wait_pending()
+        self.logger.debug("_send_command:%s", command)
         try:
-            for c in command:
-                self._serial.write(c)
+            self._write(command)
         except:
             raise tellie_exception.TellieException(
                 "Lost connection with TELLIE control!")
         if not buffer_check:  # assume returns same as input
-            buffer_check = ''
-            for c in command:
-                buffer_check += c
+            buffer_check = command
         if readout is True:
             # One read command (with default timeout of 0.1s) should be
             # enough to get all the chars from the readout.
-            buffer_read = self._serial.read(len(buffer_check))
-            if str(buffer_read) != str(buffer_check):
-                self.logger.debug(
-                    "problem reading buffer, send %s, read %s" % (command,
-                                                                  buffer_read))
+            buffer_read = self._read(len(buffer_check))
+            if buffer_read != buffer_check:
+                self.logger.debug("problem reading buffer, send %s, read %s",
+                                  command, buffer_read)
                 # clear anything else that might be in there
-                time.sleep(0.1)
-                remainder = self._serial.read(100)
-                self._serial.write("X")  # send a stop
-                time.sleep(0.1)
-                self._serial.write("C")  # send a clear
-                time.sleep(0.1)
-                self._serial.read(100)
+                remainder = self._wait_idle()
+                self._write(_cmd_stop)
+                self._write(_cmd_channel_clear)
+                self._wait_idle()
                 message = ("Unexpected buffer output:\nsaw: %s, remainder "
                            "%s\nexpected: %s" % (buffer_read, remainder,
                                                  buffer_check))
                 self.logger.warn(message)
                 raise tellie_exception.TellieException(message)
             else:
-                self.logger.debug("success reading buffer:%s" % buffer_read)
+                self.logger.debug("success reading buffer:%s", buffer_read)
         else:
             self.logger.debug("not a readout command")
 
+    def _wait_idle(self, timeout=_idle_timeout):
+        """Drain the input until it has been quiet for _idle_gap, or until
+        timeout has passed.  Returns the bytes read."""
+        drained = bytearray()
+        now = time.time()
+        deadline = now + timeout
+        last_rx = now
+        while now < deadline:
+            n = self._serial.in_waiting
+            if n:
+                drained += self._read(n)
+                last_rx = now
+            elif now - last_rx >= _idle_gap:
+                break
+            time.sleep(0.001)
+            now = time.time()
+        return bytes(drained)
+
     def _send_setting_command(self, command, buffer_check=None,
                               while_fire=False):
         """Send non-firing command.
         All of these should have a clear buffer before being used.  Can set
         while_fire to True to allow a non-fire command to be sent while firing
         (will cause PIN readout to be flushed to buffer).
+        As with _send_command, command can be bytes or a list of fragments.
         """
         self.logger.debug("Send non-firing command")
+        if type(command) is list:
+            command = b"".join(command)
         if self._firing is True:
             if while_fire is False:
                 raise tellie_exception.TellieException(
                     "Cannot run command, in firing mode")
             else:
                 # Assume that we CANNOT readout the buffer here!
-                self._send_command(command=command, readout=False)
+                self._send_command_bytes(command=command, readout=False)
+        elif self._io_queue is not None:
+            self._io_queue.put((command, buffer_check))
         else:
             self._check_clear_buffer()
-            self._send_command(command=command, buffer_check=buffer_check)
+            self._send_command_bytes(command=command,
+                                     buffer_check=buffer_check)
 
     def reset(self):
         """Send a reset command!
@@ -195,17 +364,58 @@ class SerialCommand(object):
         Assumes that the port is open (which it is by default)
         """
         self.logger.debug("Reset!")
+        self._wait_pending()
         self._serial.setRTS(True)
-        # sleep, just in case
-        time.sleep(3.0)
+        time.sleep(_rts_hold)
         self._serial.setRTS(False)
-        # close the port and reopen?
-        time.sleep(3.0)
-
-    def check_firing(self):
-        if self._firing:
-            if _buffer_end_sequence in self.read_buffer():
-                self._firing = False
+        self._serial.reset_input_buffer()
+        # let the chip boot, then drain any start-up output until the port
+        # goes quiet so that the first command sees a clear buffer
+        time.sleep(_boot_wait)
+        self._wait_idle(timeout=_boot_timeout)
+
+    def _drain_and_check_end(self):
+        """Read any waiting bytes and look for the end of fire sequence.
+        Only the newly read bytes (plus enough of the tail to catch a
+        sequence split across reads) are searched."""
+        n = self._serial.in_waiting
+        if not n:
+            return False
+        # A multi-byte end sequence can be split across two reads, so keep
+        # the last len - 1 bytes between calls.  With the current one byte
+        # sequence keep is 0 and nothing is carried over.
+        keep = len(_buffer_end_sequence) - 1
+        start = max(len(self._rx_buf) - keep, 0)
+        self._rx_buf += self._read(n)
+        if self._rx_buf.find(_buffer_end_sequence, start) >= 0:
+            del self._rx_buf[:]
+            return True
+        if keep:
+            del self._rx_buf[:-keep]
+        else:
+            del self._rx_buf[:]
+        return False
+
+    def _poll_firing_done(self):
+        """Check whether a previous fire has completed.
+        Only reads what is already waiting, so never blocks on the port
+        timeout.  Returns True if no longer firing."""
+        if not self._firing:
+            return True
+        self._wait_pending()
+        if self._drain_and_check_end():
+            self._firing = False
+        return not self._firing
+
+    def check_firing(self, timeout=None):
+        """Wait up to timeout (default the port timeout) for the end of a
+        fire.  Returns True if still firing.  The wait paces callers that
+        poll this in a loop, as the old blocking read did."""
+        if timeout is None:
+            timeout = self._port_timeout
+        deadline = time.time() + timeout
+        while not self._poll_firing_done() and time.time() < deadline:
+            time.sleep(_firing_poll_interval)
         return self._firing
 
     def enable_external_trig(self, while_fire=False):
@@ -216,38 +426,31 @@ class SerialCommand(object):
         if self._firing is True and while_fire is False:
             raise tellie_exception.TellieException(
                 "Cannot set ext. trig, already in firing mode")
-        self._send_command(_cmd_enable_ext_trig)
+        self._send_command_bytes(_cmd_enable_ext_trig)
 
     def trigger_single(self):
         """Fire single pulse upon receiving an external trigger.
 
         """
-        if self._firing is True:
-            if _buffer_end_sequence in self.read_buffer():
-                self._firing = False
-            else:
-                raise tellie_exception.TellieException(
-                    "Cannot fire, already in firing mode")
-        self._send_command(_cmd_fire_ext_trig, False)
+        if not self._poll_firing_done():
+            raise tellie_exception.TellieException(
+                "Cannot fire, already in firing mode")
+        self._send_command_bytes(_cmd_fire_ext_trig, False)
         self._firing = True
 
     def fire(self, while_fire=False):
         """Fire tellie, place class into firing mode.
         Can send a fire command while already in fire mode if required."""
         self.logger.debug("Fire!")
-        if self._firing is True and while_fire is False:
-            if _buffer_end_sequence in self.read_buffer():
-                self._firing = False
-            else:
-                raise tellie_exception.TellieException(
-                    "Cannot fire, already in firing mode")
+        if while_fire is False and not self._poll_firing_done():
+            raise tellie_exception.TellieException(
+                "Cannot fire, already in firing mode")
         self.check_ready()
-        buffer_check = _cmd_fire_series
-        if (self._current_pn * self._current_pd) < 500:
-            buffer_check += _buffer_end_sequence
-            self._send_command(_cmd_fire_series, buffer_check=buffer_check)
+        if self._expected_duration < 500:
+            self._send_command_bytes(
+                _cmd_fire_series, buffer_check=_fire_complete_buffer_check)
         else:
-            self._send_command(_cmd_fire_series, buffer_check=buffer_check)
+            self._send_command_bytes(_cmd_fire_series)
             self._firing = True
         self._force_setting = False
 
@@ -256,66 +459,73 @@ class SerialCommand(object):
         """
         self.logger.debug("Fire sequence!")
         self.check_ready()
-        self._send_command(_cmd_fire_series, False)
+        self._send_command_bytes(_cmd_fire_series, False)
         self._firing = True
         self._force_setting = False
 
     def fire_single(self):
         """Fire single pulse
         """
-        if self._firing is True:
-            if _buffer_end_sequence in self.read_buffer():
-                self._firing = False
-            else:
-                raise tellie_exception.TellieException(
-                    "Cannot fire, already in firing mode")
+        if not self._poll_firing_done():
+            raise tellie_exception.TellieException(
+                "Cannot fire, already in firing mode")
         if self._channel <= 56:  # up to box 7
             cmd = _cmd_read_single_lower
         else:
             cmd = _cmd_read_single_upper
-        self._send_command(cmd, False)
+        self._send_command_bytes(cmd, False)
         self._firing = True
-        pin = self.read_pin(self._channel[0])
+        channel = self._channel[0]
+        pin = self.read_pin(channel)
         while not pin:
-            pin = self.read_pin(self._channel[0])
+            # back off so the USB packet can fill rather than spinning
+            time.sleep(_pin_poll_interval)
+            pin = self.read_pin(channel)
         return pin
 
     def fire_continuous(self):
         """Fire Tellie in continous mode.
         """
-        if self._firing is True:
-            if _buffer_end_sequence in self.read_buffer():
-                self._firing = False
-            else:
-                raise tellie_exception.TellieException(
-                    "Cannot fire, already in firing mode")
-        self._send_command(_cmd_fire_continuous, False)
+        if not self._poll_firing_done():
+            raise tellie_exception.TellieException(
+                "Cannot fire, already in firing mode")
+        self._send_command_bytes(_cmd_fire_continuous, False)
         self._firing = True
         self._force_setting = False
 
     def read_buffer(self, n=100):
-        return self._serial.read(n)
+        self._wait_pending()
+        return self._read(n)
 
     def stop(self):
-        """Stop firing tellie"""
+        """Stop firing tellie.
+        The stop is always sent; an error from a queued setting (pipelined
+        mode) is raised afterwards."""
         self.logger.debug("Stop firing!")
-        self._send_command(_cmd_stop, False)
-        buffer_contents = self._serial.read(100)
+        error = None
+        try:
+            self._wait_pending()
+        except Exception, e:
+            error = e
+        self._send_command_bytes(_cmd_stop, False)
+        buffer_contents = self._read(100)
         self._firing = False
+        if error is not None:
+            raise error
         return buffer_contents
 
     def check_ready(self):
         """Check that all settings have been set"""
         not_set = []
-        if self._current_ph is None:
+        if self._current["ph"] is None:
             not_set += ["Pulse height"]
         #if self._current_fd is None:
         #    not_set += ["Fibre delay"]
-        if self._current_pn is None:
+        if self._current["pn"] is None:
             not_set += ["Pulse number"]
-        if self._current_pd is None:
+        if self._current["pd"] is None:
             not_set += ["Pulse delay"]
-        #if self._current_td is None:
+        #if self._current["td"] is None:
         #    not_set += ["Trigger delay"]
         if not_set != []:
             raise tellie_exception.TellieException(
@@ -323,23 +533,41 @@ class SerialCommand(object):
 
     def clear_settings(self):
         """Clear settings that affect all channels"""
-        self._current_pw = None
-        self._current_ph = None
+        self._current = dict.fromkeys(_setting_encoders)
         self._current_fd = None
-        self._current_pn = None
-        self._current_pd = None
-        self._current_td = None
+        # subclasses with their own pulse width cache
+        self._current_pw = None
+        self._expected_duration = 0
+
+    def _update_expected_duration(self):
+        """Cache the time (ms) taken to fire the current pulse train"""
+        self._expected_duration = ((self._current["pn"] or 0) *
+                                   (self._current["pd"] or 0))
+
+    def _needs_set(self, key, par):
+        """Whether a global setting differs from the cached value (or a
+        resend is being forced)"""
+        return self._force_setting or self._current[key] != par
+
+    def _maybe_set(self, key, par, encoder):
+        """Send a global setting unless it matches the cached value.
+        Returns True if the setting was sent."""
+        if not self._needs_set(key, par):
+            return False  # same as current setting
+        self.logger.debug("Set %s %s %s", key, par, type(par))
+        command, buffer_check = encoder(par)
+        self._send_setting_command(command=command,
+                                   buffer_check=buffer_check)
+        self._current[key] = par
+        return True
 
     def set_pulse_height(self, par):
         """Set the pulse height for the selected channel"""
-        if par == self._current_ph and not self._force_setting:
-            pass  # same as current setting
-        else:
-            self.logger.debug("Set pulse height %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_height(par)
-            self._send_setting_command(command=command,
-                                       buffer_check=buffer_check)
-            self._current_ph = par
+        self._maybe_set("ph", par, command_pulse_height)
+
+    def set_pulse_width(self, par):
+        """Set the pulse width (global setting)"""
+        self._maybe_set("pw", par, command_pulse_width)
 
     def set_fibre_delay(self, par):
         """Set the fibre (channel) delay for the selected channel"""
@@ -351,131 +579,189 @@ class SerialCommand(object):
            not self._force_setting:
             pass
         else:
-            self.logger.debug("Set Fibre delay %s %s" % (par, type(par)))
             command, buffer_check = command_fibre_delay(par)
+            self.logger.debug("Set Fibre delay %s %s: %r", par, type(par),
+                              command)
             self._send_channel_setting_command(command=command,
                                                buffer_check=buffer_check)
             self._current_fd[self._channel[0]] = par
 
     def set_pulse_number(self, par):
         """Set the number of pulses to fire (global setting)"""
-        if par == self._current_pn and not self._force_setting:
-            pass
-        else:
-            self.logger.debug("Set pulse number %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_number(par)
-            self._send_setting_command(command=command,
-                                       buffer_check=buffer_check)
-            self._current_pn = par
+        if self._maybe_set("pn", par, command_pulse_number):
+            self._update_expected_duration()
 
     def set_pulse_delay(self, par):
         """Set the delay between pulses (global setting)"""
-        if par == self._current_pd and not self._force_setting:
-            pass
-        else:
-            self.logger.debug("Set pulse delay %s %s" % (par, type(par)))
-            command, buffer_check = command_pulse_delay(par)
-            self._send_setting_command(command=command,
-                                       buffer_check=buffer_check)
-            self._current_pd = par
+        if self._maybe_set("pd", par, command_pulse_delay):
+            self._update_expected_duration()
 
     def set_trigger_delay(self, par):
         """Set the trigger delay (global setting)"""
-        if par == self._current_td and not self._force_setting:
-            pass
-        else:
-            self.logger.debug("Set trigger delay %s %s" % (par, type(par)))
-            command, buffer_check = command_trigger_delay(par)
-            self._send_setting_command(command=command,
-                                       buffer_check=buffer_check)
-            self._current_td = par
+        self._maybe_set("td", par, command_trigger_delay)
+
+    def configure(self, **kwargs):
+        """Set several global parameters with a single write and echo read.
+        Keywords are ph, pw, pn, pd and td (pulse height, pulse width,
+        pulse number, pulse delay and trigger delay).  As with the set_*
+        methods, values matching the current setting are not re-sent."""
+        for key in kwargs:
+            if key not in _setting_encoders:
+                raise tellie_exception.TellieException(
+                    "Unknown setting: %s" % key)
+        commands = []
+        buffer_checks = []
+        changed = []
+        for key, encoder in _setting_commands:
+            if key not in kwargs:
+                continue
+            par = kwargs[key]
+            if not self._needs_set(key, par):
+                continue
+            command, buffer_check = encoder(par)
+            commands.append(command)
+            buffer_checks.append(buffer_check)
+            changed.append((key, par))
+        if not commands:
+            return
+        self.logger.debug("Configure %s", changed)
+        self._send_setting_command(command=b"".join(commands),
+                                   buffer_check=b"".join(buffer_checks))
+        self._current.update(changed)
+        self._update_expected_duration()
 
     def disable_external_trigger(self):
         """Disable the external trigger"""
-        self._send_command(command="B")
+        self._send_command_bytes(command=_cmd_disable_ext_trig)
 
 
 ##################################################
 # Command options and corresponding buffer outputs
 #
 
+def _int_key(name, par):
+    """Cache key for the integer encoders, so that 1 and 1.0 share an entry.
+    Non-integral values are rejected rather than truncated; name is the
+    setting, for the error message."""
+    try:
+        key = int(par)
+    except (TypeError, ValueError, OverflowError):
+        key = None
+    if key is None or key != par:
+        raise tellie_exception.TellieException(
+            "Invalid %s (must be an integer): %s" % (name, par))
+    return key
+
+
+def _memoize(maxsize=256, key=None):
+    """Cache command encodings on their parameter.
+    The cache is emptied once it holds maxsize entries.  If given, key
+    maps the parameter to the (quantised) value that is encoded."""
+    def decorator(func):
+        cache = {}
+
+        @functools.wraps(func)
+        def wrapper(par):
+            if key is not None:
+                par = key(par)
+            try:
+                return cache[par]
+            except KeyError:
+                pass
+            result = func(par)
+            if len(cache) >= maxsize:
+                cache.clear()
+            cache[par] = result
+            return result
+        return wrapper
+    return decorator
+
+
+@_memoize(key=functools.partial(_int_key, "pulse height"))
 def command_pulse_height(par):
     """Get the command to set a pulse height"""
-    if par > _max_pulse_height or par < 0:
+    if not 0 <= par <= _max_pulse_height:
         raise tellie_exception.TellieException(
             "Invalid pulse height: %s" % par)
-    hi = par >> 8
-    lo = par & 255
-    command = [_cmd_ph_hi+chr(hi)]
-    command += [_cmd_ph_lo+chr(lo)]
-    command += [_cmd_ph_end]
-    buffer_check = _cmd_ph_hi + _cmd_ph_lo + _cmd_ph_end
-    return command, buffer_check
+    command = _ph_pack(_cmd_ph_hi, par >> 8, _cmd_ph_lo, par & 255,
+                       _cmd_ph_end)
+    return command, _ph_buffer_check
 
 
+@_memoize(key=functools.partial(_int_key, "pulse width"))
 def command_pulse_width(par):
     """Get the command to set a pulse width"""
-    if par > _max_pulse_width or par < 0:
+    if not 0 <= par <= _max_pulse_width:
         raise tellie_exception.TellieException(
             "Invalid pulse width: %s %s %s" % (par,
                                                _max_pulse_width,
                                                par > _max_pulse_width))
-    hi = par >> 8
-    lo = par & 255
-    command = [_cmd_pw_hi+chr(hi)]
-    command += [_cmd_pw_lo+chr(lo)+_cmd_pw_end]
-    buffer_check = _cmd_pw_hi + _cmd_pw_lo + _cmd_pw_end
-    return command, buffer_check
+    command = _pw_pack(_cmd_pw_hi, par >> 8, _cmd_pw_lo, par & 255,
+                       _cmd_pw_end)
+    return command, _pw_buffer_check
 
 
+@_memoize(key=functools.partial(_int_key, "pulse number"))
 def command_pulse_number(par):
     """Get the command to set a pulse number"""
-    if par > _max_pulse_number or par < 0:
+    if not 0 <= par <= _max_pulse_number:
         raise tellie_exception.TellieException("Invalid pulse number: %s" %
                                                (par))
-    par = int(par)
     adjusted, actual_par, hi, lo = parameters.pulse_number(par)
     if adjusted is True:
         raise tellie_exception.TellieException("Invalid pulse number: %s" %
                                                (par))
-    command = [_cmd_pn_hi+chr(hi)]
-    command += [_cmd_pn_lo+chr(lo)]
-    buffer_check = _cmd_pn_hi + _cmd_pn_lo
-    return command, buffer_check
+    command = _pn_pack(_cmd_pn_hi, hi, _cmd_pn_lo, lo)
+    return command, _pn_buffer_check
 
 
 def command_pulse_delay(par):
     """Get the command to set a pulse delay"""
-    if par > _max_pulse_delay or par < 0:
+    if not 0 <= par <= _max_pulse_delay:
         raise tellie_exception.TellieException("Invalid pulse delay: %s" % par)
-    ms = int(par)
-    us = int((par-ms)*250)
-    command = [_cmd_pd+chr(ms)]
-    command += [chr(us)]
+    # delay is sent as whole ms plus a count of 4us steps
+    return _command_pulse_delay_steps(int(round(par * 250)))
+
+
+@_memoize()
+def _command_pulse_delay_steps(steps):
+    """Get the command to set a pulse delay of steps * 4us"""
+    ms, us = divmod(steps, 250)
+    command = _pd_pack(_cmd_pd, ms, us)
     buffer_check = _cmd_pd
     return command, buffer_check
 
 
+@_memoize(key=functools.partial(_int_key, "trigger delay"))
 def command_trigger_delay(par):
     """Get the command to set a trigger delay"""
-    if par > _max_trigger_delay or par < 0:
+    if not 0 <= par <= _max_trigger_delay:
         raise tellie_exception.TellieException("Invalid trigger delay: %s" %
                                                par)
-    command = [_cmd_td+chr(par/5)]
+    command = _td_pack(_cmd_td, par // 5)
     buffer_check = _cmd_td
     return command, buffer_check
 
 
+@_memoize()
 def command_fibre_delay(par):
     """Get the command to set a fibre delay"""
-    if par > _max_fibre_delay or par < 0:
+    if not 0 <= par <= _max_fibre_delay:
         raise tellie_exception.TellieException("Invalid fibre delay: %s" %
                                                par)
     adjusted, adj_delay, setting = parameters.fibre_delay(par)
-    print "COMMAND", par, adjusted, adj_delay, setting
     if adjusted is True:
         raise tellie_exception.TellieException("Invalid delay: %s" %
                                                (par))
-    command = [_cmd_fd+chr(setting)]
+    command = _fd_pack(_cmd_fd, setting)
     buffer_check = _cmd_fd
     return command, buffer_check
+
+
+# Global settings accepted by SerialCommand.configure, in the order sent
+_setting_commands = (("ph", command_pulse_height),
+                     ("pw", command_pulse_width),
+                     ("pn", command_pulse_number),
+                     ("pd", command_pulse_delay),
+                     ("td", command_trigger_delay))
+_setting_encoders = dict(_setting_commands)
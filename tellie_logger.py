@@ -72,8 +72,12 @@ class TellieLogger:
     def log(self, message):
         log_message(message, self._log_file)
 
-    def debug(self, message):
+    def debug(self, message, *args):
+        """Log in debug mode only.  Any args are %-formatted into the
+        message here, so nothing is formatted when debug mode is off."""
         if self._debug_mode:
+            if args:
+                message = message % args
             log_message("DEBUG: " + message, self._log_file, self._coldbg)
 
     def warn(self, message):
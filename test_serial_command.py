@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+#
+# test_serial_command
+#
+# Unit tests for SerialCommand, run against a fake serial port.
+#
+###########################################
+###########################################
+
+import gc
+import struct
+import unittest
+import weakref
+
+import serial_command
+import tellie_exception
+
+
+class FakeSerial(object):
+    """Stands in for serial.Serial.
+    Echoes the command letters of each write, as TELLIE does, and adds any
+    extra reply registered for that write."""
+
+    def __init__(self, **kwargs):
+        self.writes = []
+        self.replies = {serial_command._cmd_fire_series:
+                        serial_command._buffer_end_sequence}
+        self.echo = True
+        self.truncate_echo = False
+        self.closed = False
+        self._rx = b""
+
+    @property
+    def in_waiting(self):
+        return len(self._rx)
+
+    def write(self, data):
+        self.writes.append(data)
+        if self.echo:
+            echo = b"".join(c for c in data if c.isalpha())
+            if self.truncate_echo:
+                echo = echo[:-1]
+            self._rx += echo
+        self._rx += self.replies.get(data, b"")
+
+    def read(self, n=1):
+        data, self._rx = self._rx[:n], self._rx[n:]
+        return data
+
+    def setRTS(self, level=True):
+        pass
+
+    def reset_input_buffer(self):
+        self._rx = b""
+
+    def close(self):
+        self.closed = True
+
+
+class TestCommands(unittest.TestCase):
+
+    def test_integer_encoders_name_rejected_setting(self):
+        for encoder, name in [
+                (serial_command.command_pulse_height, "pulse height"),
+                (serial_command.command_pulse_width, "pulse width"),
+                (serial_command.command_pulse_number, "pulse number"),
+                (serial_command.command_trigger_delay, "trigger delay")]:
+            try:
+                encoder(1.5)
+            except tellie_exception.TellieException, e:
+                self.assertTrue(name in str(e), str(e))
+            else:
+                self.fail("%s accepted 1.5" % name)
+        # integral floats encode the same as ints
+        self.assertEqual(serial_command.command_pulse_height(2.0),
+                         serial_command.command_pulse_height(2))
+
+
+    def test_pulse_delay_encodes_grid_values(self):
+        encode = serial_command.command_pulse_delay
+        self.assertEqual(encode(1.0), (b"u\x01\x00", b"u"))
+        # 1.144ms is 36 steps; truncation used to send 35
+        self.assertEqual(encode(1.144), (b"u\x01$", b"u"))
+        self.assertEqual(encode(0.0059), (b"u\x00\x01", b"u"))
+        for ms in range(256):
+            for us in range(250):
+                self.assertEqual(encode(round(ms + us / 250., 3))[0],
+                                 struct.pack(">cBB", b"u", ms, us))
+
+    def test_pulse_delay_limit(self):
+        encode = serial_command.command_pulse_delay
+        self.assertEqual(encode(255.996), (b"u\xff\xf9", b"u"))
+        for par in (255.998, 256.02, -0.004):
+            self.assertRaises(tellie_exception.TellieException, encode, par)
+
+
+class TestSerialCommand(unittest.TestCase):
+
+    def setUp(self):
+        self._serial_class = serial_command.serial.Serial
+        serial_command.serial.Serial = FakeSerial
+        self.sc = serial_command.SerialCommand()
+        self.port = self.sc._serial
+
+    def tearDown(self):
+        serial_command.serial.Serial = self._serial_class
+        self.sc.close()
+
+    def test_setting_command_accepts_fragment_list(self):
+        self.sc._send_setting_command([b"Q\x00", b"R\x05S"],
+                                      buffer_check=b"QRS")
+        self.assertEqual(self.port.writes, [b"Q\x00R\x05S"])
+
+    def test_clear_settings_resends_pulse_width(self):
+        self.sc.set_pulse_width(200)
+        self.sc.configure(pw=200)
+        self.assertEqual(self.port.writes, [b"Q\x00R\xc8S"])
+        self.sc.clear_settings()
+        self.sc.set_pulse_width(200)
+        self.assertEqual(self.port.writes, [b"Q\x00R\xc8S"] * 2)
+
+    def test_configure_sends_settings_in_order_as_one_write(self):
+        self.sc.configure(td=50, pd=1.0, pn=10, pw=200, ph=1000)
+        self.assertEqual(self.port.writes,
+                         [b"L\x03M\xe8P" + b"Q\x00R\xc8S" + b"H\x01G\n" +
+                          b"u\x01\x00" + b"d\n"])
+        self.assertEqual(self.sc._current,
+                         {"ph": 1000, "pw": 200, "pn": 10, "pd": 1.0,
+                          "td": 50})
+
+    def test_configure_checks_joined_echo(self):
+        # a correct pulse height echo is not enough, the whole of the
+        # joined echo (LMPHG) must come back
+        self.port.truncate_echo = True
+        self.assertRaises(tellie_exception.TellieException,
+                          self.sc.configure, ph=1000, pn=10)
+        self.assertEqual(self.port.writes,
+                         [b"L\x03M\xe8PH\x01G\n", b"X", b"C"])
+        self.assertEqual(self.sc._current["ph"], None)
+        self.assertEqual(self.sc._current["pn"], None)
+
+    def test_configure_skips_unchanged_values(self):
+        self.sc.set_pulse_height(1000)
+        self.port.writes = []
+        self.sc.configure(ph=1000, pn=10)
+        self.assertEqual(self.port.writes, [b"H\x01G\n"])
+        self.port.writes = []
+        self.sc.configure(ph=1000, pn=10)
+        self.assertEqual(self.port.writes, [])
+
+    def test_configure_rejects_unknown_setting(self):
+        self.assertRaises(tellie_exception.TellieException,
+                          self.sc.configure, ph=1000, fd=1.0)
+        self.assertEqual(self.port.writes, [])
+        self.assertEqual(self.sc._current["ph"], None)
+
+    def test_configure_sends_nothing_if_an_encoder_fails(self):
+        self.assertRaises(tellie_exception.TellieException,
+                          self.sc.configure, ph=1000, pn=1.5)
+        self.assertEqual(self.port.writes, [])
+        self.assertEqual(self.sc._current["ph"], None)
+
+
+class TestPipelined(unittest.TestCase):
+
+    def setUp(self):
+        self._serial_class = serial_command.serial.Serial
+        serial_command.serial.Serial = FakeSerial
+        self.sc = serial_command.SerialCommand(pipelined=True)
+        self.port = self.sc._serial
+
+    def tearDown(self):
+        serial_command.serial.Serial = self._serial_class
+        if self.sc is not None:
+            try:
+                self.sc.close()
+            except tellie_exception.TellieException:
+                pass
+
+    def test_fire_waits_for_queued_settings(self):
+        self.sc.set_pulse_height(1000)
+        self.sc.configure(pn=10, pd=1.0)
+        self.sc.fire()
+        self.assertEqual(self.port.writes,
+                         [b"L\x03M\xe8P", b"H\x01G\nu\x01\x00", b"g"])
+        self.assertFalse(self.sc._firing)
+
+    def test_error_raised_at_barrier(self):
+        self.port.echo = False
+        self.sc.set_pulse_height(1000)
+        self.sc.set_pulse_number(10)
+        self.sc.set_pulse_delay(1.0)
+        self.assertRaises(tellie_exception.TellieException, self.sc.fire)
+        # only the failed command and its stop/clear recovery were sent
+        self.assertEqual(self.port.writes, [b"L\x03M\xe8P", b"X", b"C"])
+        self.assertEqual(set(self.sc._current.values()), set([None]))
+        # the error is only raised once, after which settings are resent
+        self.port.echo = True
+        self.port.writes = []
+        self.sc.set_pulse_height(1000)
+        self.sc.close()
+        self.assertEqual(self.port.writes, [b"L\x03M\xe8P"])
+
+    def test_stop_sent_before_queued_error_is_raised(self):
+        self.port.echo = False
+        self.sc.set_pulse_height(1000)
+        self.assertRaises(tellie_exception.TellieException, self.sc.stop)
+        self.assertEqual(self.port.writes[-1], b"X")
+        self.assertFalse(self.sc._firing)
+
+    def test_del_does_not_raise_queued_error(self):
+        self.port.echo = False
+        self.sc.set_pulse_height(1000)
+        self.sc.__del__()
+        self.assertTrue(self.port.closed)
+        self.assertTrue(self.sc._io_thread is None)
+
+    def test_close_stops_worker_and_releases_instance(self):
+        thread = self.sc._io_thread
+        self.sc.set_pulse_height(1000)
+        self.sc.close()
+        self.assertFalse(thread.is_alive())
+        self.assertTrue(self.port.closed)
+        self.assertEqual(self.port.writes, [b"L\x03M\xe8P"])
+        ref = weakref.ref(self.sc)
+        self.sc = None
+        gc.collect()
+        self.assertTrue(ref() is None)
+
+
+if __name__ == "__main__":
+    unittest.main()